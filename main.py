@@ -1,18 +1,22 @@
 from fastapi import FastAPI, HTTPException, Query, File, UploadFile
-from pydantic import BaseModel
-from sqlalchemy import and_, create_engine, Column, Integer, String, Float, TIMESTAMP, UniqueConstraint, func
+from pydantic import BaseModel, Field, field_validator, model_validator
+from sqlalchemy import and_, create_engine, Column, Integer, String, Float, TIMESTAMP, UniqueConstraint, func, text, tuple_, column
+from sqlalchemy import values as values_clause
+from sqlalchemy.exc import OperationalError
+from psycopg2.errors import QueryCanceled
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, aliased
 from dotenv import load_dotenv
 import os
 import csv
 import io
 import re
 import logging
+import time
 from datetime import datetime
 from typing import List, Optional
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.dialects.postgresql import insert, array
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
@@ -26,7 +30,7 @@ from fastapi_cache import FastAPICache
 from fastapi_cache.backends.inmemory import InMemoryBackend
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from typing import Set
+from typing import Dict, Set
 from fastapi.websockets import WebSocket
 
 alert_connections: Set[WebSocket] = set()
@@ -56,6 +60,11 @@ load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Ограничения для /data/analytics
+ANALYTICS_MAX_RESULTS = int(os.getenv("ANALYTICS_MAX_RESULTS", "10000"))
+ANALYTICS_STATEMENT_TIMEOUT_MS = int(os.getenv("ANALYTICS_STATEMENT_TIMEOUT_MS", "30000"))
+ANALYTICS_MAX_PERCENTILES = 100
+
 engine = create_engine(DATABASE_URL, connect_args={"client_encoding": "UTF8"})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -116,6 +125,64 @@ class PaginatedResponse(BaseModel):
     data: List[SensorDataResponse]
     meta: PaginationMeta
 
+class AnalyticsWindow(BaseModel):
+    start_date: Optional[datetime] = None
+    end_date: Optional[datetime] = None
+
+    @model_validator(mode="after")
+    def check_window_order(self):
+        start_date, end_date = self.start_date, self.end_date
+        if start_date and end_date:
+            if (start_date.tzinfo is None) != (end_date.tzinfo is None):
+                raise ValueError("start_date и end_date должны быть обе с часовым поясом или обе без")
+            if start_date > end_date:
+                raise ValueError("start_date не может быть позже end_date")
+        return self
+
+def format_percentile_key(percentile: float) -> str:
+    return f"p{percentile * 100:g}"
+
+class AnalyticsRequest(BaseModel):
+    sensor_ids: List[str] = Field(..., min_length=1)
+    windows: List[AnalyticsWindow] = Field([AnalyticsWindow()], min_length=1)
+    percentiles: List[float] = Field([0.5, 0.95], max_length=ANALYTICS_MAX_PERCENTILES)
+    correlation: bool = False
+    max_results: Optional[int] = Field(None, gt=0)
+
+    @field_validator("percentiles")
+    @classmethod
+    def check_percentiles(cls, percentiles):
+        if any(not 0 <= p <= 1 for p in percentiles):
+            raise ValueError("Перцентили должны быть в диапазоне [0, 1]")
+        # Убираем дубли, в том числе совпадающие после форматирования ключа
+        unique = {}
+        for p in percentiles:
+            unique.setdefault(format_percentile_key(p), p)
+        return list(unique.values())
+
+class SensorStats(BaseModel):
+    sensor_id: str
+    window: int
+    count: int
+    mean: Optional[float]
+    stddev: Optional[float]
+    min: Optional[float]
+    max: Optional[float]
+    percentiles: Dict[str, Optional[float]]
+    rate_of_change: Optional[float]  # единиц в секунду (наклон линейной регрессии)
+
+class SensorCorrelation(BaseModel):
+    window: int
+    sensor_a: str
+    sensor_b: str
+    count: int
+    correlation: Optional[float]
+
+class AnalyticsResponse(BaseModel):
+    windows: List[AnalyticsWindow]
+    stats: List[SensorStats]
+    correlations: List[SensorCorrelation]
+
 # Модель SQLAlchemy
 class SensorData(Base):
     __tablename__ = "sensor_data"
@@ -542,4 +609,185 @@ async def check_alert(
             print('h3')
         except Exception as e:
             logging.error(f"Ошибка проверки: {str(e)}", exc_info=True)
-            raise HTTPException(500, "Ошибка при проверке уведомлений")
\ No newline at end of file
+            raise HTTPException(500, "Ошибка при проверке уведомлений")
+
+
+def format_sensor_id(pipe_number: str, sensor_type: str, sensor_number: int) -> str:
+    return f"{pipe_number}_{sensor_type}_{sensor_number}"
+
+@app.post("/data/analytics", response_model=AnalyticsResponse)
+def get_analytics(request: AnalyticsRequest = Body(...)):
+    """Статистика по набору датчиков и временных окон, вычисляемая в БД"""
+    sensors = {}
+    for sensor_id in request.sensor_ids:
+        parsed = parse_sensor_column(sensor_id)
+        if not parsed:
+            raise HTTPException(400, f"Неверный формат sensor_id: {sensor_id}")
+        sensors[format_sensor_id(**parsed)] = parsed
+
+    # Пары датчиков одной трубы для корреляции
+    pairs = []
+    if request.correlation:
+        ids = list(sensors)
+        for i, sensor_a in enumerate(ids):
+            for sensor_b in ids[i + 1:]:
+                if sensors[sensor_a]["pipe_number"] == sensors[sensor_b]["pipe_number"]:
+                    pairs.append((sensor_a, sensor_b))
+
+    # Оценка размера ответа до выполнения запросов: отменяем слишком большие
+    # (каждый перцентиль считается отдельным значением)
+    expected = (len(sensors) * (1 + len(request.percentiles)) + len(pairs)) * len(request.windows)
+    max_results = min(request.max_results or ANALYTICS_MAX_RESULTS, ANALYTICS_MAX_RESULTS)
+    if expected > max_results:
+        raise HTTPException(
+            413,
+            f"Слишком большой результат: {expected} записей при лимите {max_results}"
+        )
+
+    sensor_tuples = [
+        (p["pipe_number"], p["sensor_type"], p["sensor_number"]) for p in sensors.values()
+    ]
+
+    # Все окна передаются одним списком VALUES: на весь батч не больше двух
+    # запросов (статистика и корреляция), которые делят общий лимит времени
+    windows = values_clause(
+        column("idx", Integer),
+        column("start_date", TIMESTAMP),
+        column("end_date", TIMESTAMP),
+        name="windows"
+    ).data([
+        (index, window.start_date or datetime.min, window.end_date or datetime.max)
+        for index, window in enumerate(request.windows)
+    ])
+
+    with SessionLocal() as db:
+        try:
+            deadline = time.monotonic() + ANALYTICS_STATEMENT_TIMEOUT_MS / 1000
+            db.execute(text(f"SET LOCAL statement_timeout = {ANALYTICS_STATEMENT_TIMEOUT_MS}"))
+
+            group_by = (
+                windows.c.idx,
+                SensorData.pipe_number, SensorData.sensor_type, SensorData.sensor_number,
+            )
+            columns = [
+                *group_by,
+                func.count(SensorData.value).label("count"),
+                func.avg(SensorData.value).label("mean"),
+                func.stddev_samp(SensorData.value).label("stddev"),
+                func.min(SensorData.value).label("min"),
+                func.max(SensorData.value).label("max"),
+                func.regr_slope(
+                    SensorData.value, func.extract("epoch", SensorData.timestamp)
+                ).label("rate_of_change"),
+            ]
+            if request.percentiles:
+                columns.append(
+                    func.percentile_cont(array(request.percentiles))
+                    .within_group(SensorData.value)
+                    .label("percentiles")
+                )
+            query = db.query(*columns).select_from(SensorData).join(
+                windows,
+                and_(
+                    SensorData.timestamp >= windows.c.start_date,
+                    SensorData.timestamp <= windows.c.end_date
+                )
+            ).filter(
+                tuple_(
+                    SensorData.pipe_number, SensorData.sensor_type, SensorData.sensor_number
+                ).in_(sensor_tuples)
+            ).group_by(*group_by)
+
+            found_stats = {}
+            for row in query:
+                sensor_id = format_sensor_id(row.pipe_number, row.sensor_type, row.sensor_number)
+                found_stats[(row.idx, sensor_id)] = row
+
+            found_correlations = {}
+            if pairs:
+                # Корреляции достаётся остаток общего лимита времени
+                remaining_ms = max(int((deadline - time.monotonic()) * 1000), 1)
+                db.execute(text(f"SET LOCAL statement_timeout = {remaining_ms}"))
+
+                # Корреляция между датчиками одной трубы по совпадающим отметкам времени
+                a = aliased(SensorData)
+                b = aliased(SensorData)
+                pair_group = (
+                    windows.c.idx,
+                    a.pipe_number, a.sensor_type, a.sensor_number,
+                    b.sensor_type, b.sensor_number,
+                )
+                query = db.query(
+                    *pair_group,
+                    func.count().label("count"),
+                    func.corr(a.value, b.value).label("correlation")
+                ).select_from(a).join(
+                    windows,
+                    and_(a.timestamp >= windows.c.start_date, a.timestamp <= windows.c.end_date)
+                ).join(
+                    b,
+                    and_(
+                        a.timestamp == b.timestamp,
+                        a.pipe_number == b.pipe_number,
+                        tuple_(a.sensor_type, a.sensor_number) < tuple_(b.sensor_type, b.sensor_number)
+                    )
+                ).filter(
+                    tuple_(a.pipe_number, a.sensor_type, a.sensor_number).in_(sensor_tuples),
+                    tuple_(b.pipe_number, b.sensor_type, b.sensor_number).in_(sensor_tuples)
+                ).group_by(*pair_group)
+
+                for row in query:
+                    sensor_a = format_sensor_id(row[1], row[2], row[3])
+                    sensor_b = format_sensor_id(row[1], row[4], row[5])
+                    found_correlations[(row.idx, frozenset((sensor_a, sensor_b)))] = row
+
+        except OperationalError as e:
+            if isinstance(e.orig, QueryCanceled):
+                logging.error(f"Превышено время аналитики: {str(e)}")
+                raise HTTPException(
+                    504,
+                    f"Превышен лимит времени запроса ({ANALYTICS_STATEMENT_TIMEOUT_MS} мс)"
+                )
+            logging.error(f"Ошибка аналитики: {str(e)}", exc_info=True)
+            raise HTTPException(500, "Ошибка при расчёте статистики")
+        except Exception as e:
+            logging.error(f"Ошибка аналитики: {str(e)}", exc_info=True)
+            raise HTTPException(500, "Ошибка при расчёте статистики")
+
+    # Для каждой запрошенной пары окно/датчик возвращаем запись, даже если данных нет
+    stats = []
+    correlations = []
+    for index in range(len(request.windows)):
+        for sensor_id in sensors:
+            row = found_stats.get((index, sensor_id))
+            percentile_values = (row.percentiles if row is not None and request.percentiles else None) or []
+            stats.append(SensorStats(
+                sensor_id=sensor_id,
+                window=index,
+                count=row.count if row is not None else 0,
+                mean=row.mean if row is not None else None,
+                stddev=row.stddev if row is not None else None,
+                min=row.min if row is not None else None,
+                max=row.max if row is not None else None,
+                percentiles={
+                    format_percentile_key(p): percentile_values[i] if i < len(percentile_values) else None
+                    for i, p in enumerate(request.percentiles)
+                },
+                rate_of_change=row.rate_of_change if row is not None else None
+            ))
+
+        for sensor_a, sensor_b in pairs:
+            row = found_correlations.get((index, frozenset((sensor_a, sensor_b))))
+            correlations.append(SensorCorrelation(
+                window=index,
+                sensor_a=sensor_a,
+                sensor_b=sensor_b,
+                count=row.count if row is not None else 0,
+                correlation=row.correlation if row is not None else None
+            ))
+
+    return AnalyticsResponse(
+        windows=request.windows,
+        stats=stats,
+        correlations=correlations
+    )